@@ -166,13 +166,17 @@ def gini(x, axis=None):
     Returns: float
             Gini coefficient
     """
-    x = np.asarray(x)
+    # work on a float copy, so that it can be sorted in place without modifying the input
+    x = np.array(x, dtype=float)
     if axis is None:
-        x = x.flatten()
+        x = x.ravel()
         axis = -1
     if np.any(x < 0):
         warnings.warn("Input x contains negative values")
-    sorted_x = np.sort(x, axis=axis)
-    n = x.shape[axis]
-    cumx = np.cumsum(sorted_x, dtype=float, axis=axis)
-    return (n + 1 - 2 * np.sum(cumx, axis=axis) / cumx.take(-1, axis=axis)) / n
+    x = np.moveaxis(x, axis, -1)
+    x.sort(axis=-1)
+    n = x.shape[-1]
+    # closed form of the Gini coefficient for sorted values: (2 * sum_i(i * x_i) - (n + 1) * sum_i(x_i)) / (n * sum_i(x_i))
+    rank = np.arange(1, n + 1, dtype=float)
+    total = x.sum(axis=-1)
+    return (2 * (x @ rank) - (n + 1) * total) / (n * total)
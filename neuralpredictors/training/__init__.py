@@ -10,5 +10,5 @@ This includes:
 
 from .context_managers import device_state, eval_state
 from .cyclers import Exhauster, LongCycler, ShortCycler
-from .early_stopping import early_stopping
+from .early_stopping import early_stopping, run_early_stopping
 from .tracking import MultipleObjectiveTracker, TimeObjectiveTracker
@@ -1,9 +1,15 @@
 import copy
+import gc
 import logging
+import math
+import os
+import tempfile
 from collections import OrderedDict
+from contextlib import nullcontext
 
-import numpy as np
 import torch
+import torch.distributed as dist
+from torch import nn
 
 logger = logging.getLogger(__name__)
 
@@ -14,20 +20,137 @@ def copy_state(model):
     Args:
         model: PyTorch module to copy state dict of
 
+    Returns:
+        A copy of state dict with all tensors allocated on the CPU
+    """
+    return _copy_state_dict(model.state_dict(keep_vars=True))
+
+
+def _copy_state_dict(state_dict):
+    """
+    Makes a copy of `state_dict` onto CPU. Tensors are detached, so `state_dict` may also hold parameters as returned by
+    `model.state_dict(keep_vars=True)`.
+    Args:
+        state_dict: state dict to copy
+
     Returns:
         A copy of state dict with all tensors allocated on the CPU
     """
     copy_dict = OrderedDict()
-    state_dict = model.state_dict()
     for k, v in state_dict.items():
         if torch.is_tensor(v):
-            copy_dict[k] = v.cpu() if v.is_cuda else v.clone()
+            copy_dict[k] = v.detach().cpu() if v.is_cuda else v.detach().clone()
         else:
             copy_dict[k] = copy.deepcopy(v)
 
     return copy_dict
 
 
+def _create_cpu_state_dict(model, pin_memory=True):
+    """
+    Allocates a CPU mirror of the state dict of `model` that can be reused for repeated offloading of the state.
+    All tensors of the mirror are views into one flat CPU buffer per dtype.
+    Args:
+        model: PyTorch module whose state dict is mirrored
+        pin_memory: whether to allocate the buffers in page-locked (pinned) memory if the state contains CUDA tensors
+
+    Returns:
+        An `OrderedDict` with uninitialized CPU tensors in place of the tensors of the state dict
+    """
+    state_dict = model.state_dict(keep_vars=True)
+
+    # offset of every tensor within the flat buffer of its dtype
+    offsets, totals = {}, {}
+    for k, v in state_dict.items():
+        if torch.is_tensor(v):
+            offsets[k] = totals.get(v.dtype, 0)
+            totals[v.dtype] = offsets[k] + v.numel()
+
+    pin_memory = pin_memory and any(torch.is_tensor(v) and v.is_cuda for v in state_dict.values())
+    flats = {dtype: torch.empty(total, dtype=dtype, pin_memory=pin_memory) for dtype, total in totals.items()}
+
+    mirror = OrderedDict()
+    for k, v in state_dict.items():
+        if torch.is_tensor(v):
+            start = offsets[k]
+            mirror[k] = flats[v.dtype][start : start + v.numel()].view(v.shape)
+        else:
+            mirror[k] = copy.deepcopy(v)
+    return mirror
+
+
+def _offload_state_dict_to_cpu(state_dict, companion, stream=None, versions=None):
+    """
+    Copies the entries of `state_dict` into the preallocated CPU mirror `companion` (see `_create_cpu_state_dict`).
+    Args:
+        state_dict: state dict to copy, may also hold parameters as returned by `model.state_dict(keep_vars=True)`
+        companion: CPU mirror of `state_dict` that is written into
+        stream: CUDA stream on which the device to host copies are issued. If None, the current stream is used and the
+            function blocks until the copies have finished. Otherwise, the copies run asynchronously to the host and
+            `stream.synchronize()` must be called before reading `companion`. Work subsequently issued to the current
+            stream waits for the copies to finish, such that the state cannot be modified while it is being copied.
+        versions: if not None, dictionary of the version counters of the parameters of `state_dict` at the time of their
+            last copy into `companion`. Parameters whose version counter did not change since are skipped and the
+            dictionary is updated with the current versions. Buffers are always copied, as their version counters are not
+            reliably incremented by in-place updates (e.g. the running statistics of batch norm layers).
+
+    Returns:
+        `companion`, holding a copy of `state_dict`
+    """
+    if stream is not None:
+        # the copies must only start after all pending kernels writing to the state have finished
+        stream.wait_stream(torch.cuda.current_stream())
+    copies_cuda = False
+    # `torch.cuda.stream` queries the current CUDA device even if no stream is given, which must be avoided for CPU states
+    with torch.cuda.stream(stream) if stream is not None else nullcontext():
+        for k, v in state_dict.items():
+            if versions is not None and isinstance(v, nn.Parameter):
+                if versions.get(k) == v._version:
+                    continue
+                versions[k] = v._version
+            if torch.is_tensor(v):
+                companion[k].copy_(v.detach(), non_blocking=True)
+                copies_cuda = copies_cuda or v.is_cuda
+            else:
+                companion[k] = copy.deepcopy(v)
+    if stream is not None:
+        # e.g. optimizer steps must not update the state before it is copied
+        torch.cuda.current_stream().wait_stream(stream)
+    elif copies_cuda:
+        # non-blocking device to host copies must have finished before the mirror can be read
+        torch.cuda.synchronize()
+    return companion
+
+
+def _load_state_dict(model, state_dict, assign=False):
+    """
+    Loads `state_dict` into `model`.
+    Args:
+        model: PyTorch module to load the state into
+        state_dict: state dict to load
+        assign: if True, the tensors of `state_dict` are assigned to the model instead of being copied into the existing
+            parameters and buffers, which are then moved back onto the original device of the model in one go. Note that
+            this replaces the parameter objects of the model. Falls back to copying if the model shares tensors between
+            several entries of its state (e.g. tied weights), if its state is spread over several devices, or for
+            PyTorch versions before 2.1.
+    """
+    tensors = [v for v in model.state_dict(keep_vars=True).values() if torch.is_tensor(v)]
+    devices = {v.device for v in tensors}
+    # assigning would untie shared tensors and move the whole model onto a single device
+    if not assign or len({id(v) for v in tensors}) < len(tensors) or len(devices) != 1:
+        model.load_state_dict(state_dict)
+        return
+
+    device = devices.pop()
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        # `assign` is not supported by `load_state_dict` before PyTorch 2.1
+        model.load_state_dict(state_dict)
+    else:
+        model.to(device)
+
+
 def early_stopping(
     model,
     objective,
@@ -43,6 +166,11 @@ def early_stopping(
     scheduler=None,
     lr_decay_steps=1,
     number_warmup_epochs=0,
+    checkpoint_to_disk=False,
+    empty_cache_on_decay=True,
+    distributed=False,
+    differential_checkpoint=False,
+    assign_best_state=False,
 ):
     """
     Early stopping iterator. Keeps track of the best model state during training. Resets the model to its
@@ -58,7 +186,8 @@ def early_stopping(
     Args:
         model:     model that is being optimized
         objective: objective function that is used for early stopping. The function must accept single positional argument `model`
-            and return a single scalar quantity.
+            and return a single scalar quantity. The objective is evaluated under `torch.inference_mode()`, hence no
+            autograd graph is recorded and it must not perform autograd tracked in-place operations on the model.
         interval:  interval at which objective is evaluated to consider early stopping
         patience:  number of continuous epochs the objective could remain without improvement before the iterator terminates
         start:     start value for iteration (used to check against `max_iter`)
@@ -96,27 +225,132 @@ def early_stopping(
                     consider adjusting the warm up function accordingly.
         lr_decay_steps: Number of times the learning rate should be reduced before stopping the training.
         number_warmup_epochs: Number of warm-up epochs
+        checkpoint_to_disk: whether to keep the best model state in a temporary file instead of in host memory. The file
+                    is removed once the iterator is exhausted or closed.
+        empty_cache_on_decay: whether to run the garbage collector and release the memory cached by the CUDA allocator
+                    after each lr decay, to reduce fragmentation before training resumes.
+        distributed: whether early stopping runs in all processes of a distributed (e.g. DistributedDataParallel) training.
+                    If so, the objective is averaged across all processes, such that all of them take the same decisions,
+                    and only the process with rank 0 keeps a copy of the best state, which is broadcast to all other
+                    processes upon restoring. Requires the default process group of `torch.distributed` to be
+                    initialized and the iterator to be run in all of its processes.
+        differential_checkpoint: whether to only copy the parameters that changed since the last copy of the best state,
+                    based on their version counters. The best state is then kept in a persistent CPU mirror. Note that
+                    in-place updates via `.data` do not increment the version counter of a parameter, and neither do
+                    the fused implementations of the optimizers in `torch.optim` (e.g. `Adam(..., fused=True)`), whereas
+                    their default and `foreach` implementations do. This must only be used if the parameters are solely
+                    updated by operations that increment their version counter, otherwise a stale state is restored.
+                    Has no effect if `checkpoint_to_disk` is set.
+        assign_best_state: whether to assign the best state to the model at the end of early stopping instead of copying
+                    it into the existing parameters and buffers. This replaces the parameter objects of the model, hence
+                    optimizers (or any other references to the parameters) need to be recreated afterwards. Restoring
+                    after lr decay always copies in place.
     """
     training_status = model.training
 
+    is_main_process = not distributed or dist.get_rank() == 0
+    # NCCL only communicates CUDA tensors
+    collective_device = (
+        torch.device("cuda", torch.cuda.current_device())
+        if distributed and dist.get_backend() == "nccl"
+        else torch.device("cpu")
+    )
+
+    def _reduce(value):
+        if not distributed:
+            return value
+        value = torch.tensor([float(value)], dtype=torch.float64, device=collective_device)
+        # not every backend supports `ReduceOp.AVG`
+        dist.all_reduce(value, op=dist.ReduceOp.SUM)
+        return value.item() / dist.get_world_size()
+
     def _objective():
         if switch_mode:
             model.eval()
-        ret = objective(model)
+        with torch.inference_mode():
+            ret = objective(model)
         if switch_mode:
             model.train(training_status)
-        return ret
+        return _reduce(ret)
+
+    # references to the parameters and buffers of the model, collected once instead of rebuilding the state dict for every
+    # copy of the state. This assumes that the model is updated in place during training, i.e. that its parameters and
+    # buffers are not reassigned (e.g. by moving the model to another device) while the iterator is running.
+    state_refs = model.state_dict(keep_vars=True)
+    # the extra state of modules is computed anew by every call of `state_dict`, hence it must not be cached
+    module_extra_state = getattr(nn.Module, "get_extra_state", None)
+    has_extra_state = any(getattr(type(m), "get_extra_state", None) is not module_extra_state for m in model.modules())
+
+    def _current_state():
+        return model.state_dict(keep_vars=True) if has_extra_state else state_refs
+
+    # models living on the GPU are offloaded into a preallocated pinned CPU mirror, CPU models are simply cloned unless
+    # only the changed parameters are to be copied, which requires a persistent mirror as well
+    uses_cuda = any(torch.is_tensor(v) and v.is_cuda for v in state_refs.values())
+    offload_to_mirror = is_main_process and not checkpoint_to_disk and (uses_cuda or differential_checkpoint)
+    best_state_dict_mirror = _create_cpu_state_dict(model) if offload_to_mirror else None
+    offload_stream = torch.cuda.Stream() if offload_to_mirror and uses_cuda else None
+    mirror_versions = {} if differential_checkpoint else None
+
+    best_ckpt_path = None
+    if checkpoint_to_disk and is_main_process:
+        with tempfile.NamedTemporaryFile(suffix=".pt", delete=False) as f:
+            best_ckpt_path = f.name
+
+    def _copy_state():
+        # in distributed training, the state is identical across processes and only kept by the main process
+        if not is_main_process:
+            return None
+        state = _current_state()
+        if checkpoint_to_disk:
+            state_dict = {k: (v.detach().cpu() if torch.is_tensor(v) else v) for k, v in state.items()}
+            torch.save(state_dict, best_ckpt_path)
+            return best_ckpt_path
+        if offload_to_mirror:
+            return _offload_state_dict_to_cpu(
+                state, companion=best_state_dict_mirror, stream=offload_stream, versions=mirror_versions
+            )
+        return _copy_state_dict(state)
+
+    def _load_best_state(best_state_dict, assign=False):
+        if is_main_process:
+            if offload_stream is not None:
+                # wait for the asynchronous copy into the mirror to finish
+                offload_stream.synchronize()
+            if checkpoint_to_disk:
+                # the file was written by `_copy_state`, so it can be fully unpickled (e.g. arbitrary extra state)
+                try:
+                    best_state_dict = torch.load(best_state_dict, map_location="cpu", weights_only=False)
+                except TypeError:
+                    # `weights_only` is not supported by `torch.load` before PyTorch 1.13
+                    best_state_dict = torch.load(best_state_dict, map_location="cpu")
+            # parameters must not be replaced in distributed training, as they are shared with e.g. the DDP wrapper
+            _load_state_dict(model, best_state_dict, assign=assign and not distributed)
+        if distributed:
+            for v in model.state_dict().values():
+                if not torch.is_tensor(v):
+                    continue
+                if collective_device.type == "cuda" and not v.is_cuda:
+                    buffer = v.to(collective_device)
+                    dist.broadcast(buffer, src=0)
+                    v.copy_(buffer)
+                else:
+                    dist.broadcast(v, src=0)
 
     def decay_lr(model, best_state_dict):
         old_objective = _objective()
         if restore_best:
-            model.load_state_dict(best_state_dict)
+            _load_best_state(best_state_dict)
             logger.info(f"Restoring best model after lr decay! {old_objective:.6f} ---> {_objective():.6f}")
+        if empty_cache_on_decay:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
     def finalize(model, best_state_dict):
         old_objective = _objective()
         if restore_best:
-            model.load_state_dict(best_state_dict)
+            _load_best_state(best_state_dict, assign=assign_best_state)
             logger.info(f"Restoring best model! {old_objective:.6f} ---> {_objective():.6f}")
         else:
             logger.info(f"Final best model! objective {_objective():.6f}")
@@ -124,85 +358,110 @@ def early_stopping(
     epoch = start
     # turn into a sign
     maximize = -1 if maximize else 1
-    best_objective = current_objective = _objective()
-    best_state_dict = copy_state(model)
-
-    # check if the learning rate scheduler is 'ReduceLROnPlateau' so that we pass the current_objective to step
-    reduce_lr_on_plateau = False
-    if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
-        reduce_lr_on_plateau = True
-    elif isinstance(scheduler, tuple):
-        if isinstance(scheduler[1], torch.optim.lr_scheduler.ReduceLROnPlateau):
+    try:
+        best_objective = current_objective = _objective()
+        best_state_dict = _copy_state()
+
+        # check if the learning rate scheduler is 'ReduceLROnPlateau' so that we pass the current_objective to step
+        reduce_lr_on_plateau = False
+        if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
             reduce_lr_on_plateau = True
+        elif isinstance(scheduler, tuple):
+            if isinstance(scheduler[1], torch.optim.lr_scheduler.ReduceLROnPlateau):
+                reduce_lr_on_plateau = True
+
+        # check if warm up is to be performed
+        if isinstance(scheduler, tuple):
+            warmup = True
+
+            # check if the warm-up scheduler is not of type None
+            if scheduler[0] is None:
+                logger.warning(
+                    f"Provided warm up scheduler is of type None. Warm up epochs set to {number_warmup_epochs}. Setting number of warm up epochs to 0"
+                )
+                number_warmup_epochs = 0
+        else:
+            warmup = False
 
-    # check if warm up is to be performed
-    if isinstance(scheduler, tuple):
-        warmup = True
+        # check if warm up scheduler and number of warm-up epochs is provided
+        if warmup and number_warmup_epochs == 0:
+            logger.warning("Warm up scheduler is provided, but number of warm up steps is set to 0")
 
-        # check if the warm-up scheduler is not of type None
-        if scheduler[0] is None:
+        # inform user that no warm-up scheduler is provided althouth warm-up epochs is non zero
+        elif not warmup and number_warmup_epochs > 0:
             logger.warning(
-                f"Provided warm up scheduler is of type None. Warm up epochs set to {number_warmup_epochs}. Setting number of warm up epochs to 0"
+                f"Number of warm up steps is set to {number_warmup_epochs}, but no warm up scheduler is provided"
             )
-            number_warmup_epochs = 0
-    else:
-        warmup = False
-
-    # check if warm up scheduler and number of warm-up epochs is provided
-    if warmup and number_warmup_epochs == 0:
-        logger.warning("Warm up scheduler is provided, but number of warm up steps is set to 0")
-
-    # inform user that no warm-up scheduler is provided althouth warm-up epochs is non zero
-    elif not warmup and number_warmup_epochs > 0:
-        logger.warning(
-            f"Number of warm up steps is set to {number_warmup_epochs}, but no warm up scheduler is provided"
-        )
-
-    for repeat in range(lr_decay_steps):
-        patience_counter = 0
-
-        while patience_counter < patience and epoch < max_iter:
-            for _ in range(interval):
-                epoch += 1
-                if tracker is not None:
-                    tracker.log_objective(current_objective)
-                if (~np.isfinite(current_objective)).any():
-                    logger.warning("Objective is not Finite. Stopping training")
-                    finalize(model, best_state_dict)
-                    return
-                yield epoch, current_objective
-
-            current_objective = _objective()
-
-            # if a scheduler is defined, a .step with or without the current objective is all that is needed to reduce the LR
-            if scheduler is not None:
-                if warmup and epoch < number_warmup_epochs:
-                    # warm-up step
-                    scheduler[0].step()
-                elif reduce_lr_on_plateau:
-                    # reduce_lr_on_plateau requires current objective for the step
-                    if not warmup:
-                        scheduler.step(current_objective)
+
+        for repeat in range(lr_decay_steps):
+            patience_counter = 0
+
+            while patience_counter < patience and epoch < max_iter:
+                for _ in range(interval):
+                    epoch += 1
+                    if tracker is not None:
+                        tracker.log_objective(current_objective)
+                    if not math.isfinite(current_objective):
+                        logger.warning("Objective is not Finite. Stopping training")
+                        finalize(model, best_state_dict)
+                        return
+                    yield epoch, current_objective
+
+                current_objective = _objective()
+
+                # if a scheduler is defined, a .step with or without the current objective is all that is needed to reduce the LR
+                if scheduler is not None:
+                    if warmup and epoch < number_warmup_epochs:
+                        # warm-up step
+                        scheduler[0].step()
+                    elif reduce_lr_on_plateau:
+                        # reduce_lr_on_plateau requires current objective for the step
+                        if not warmup:
+                            scheduler.step(current_objective)
+                        else:
+                            scheduler[1].step(current_objective)
                     else:
-                        scheduler[1].step(current_objective)
+                        # .step() for the rest of the schedulers
+                        if not warmup:
+                            scheduler.step()
+                        else:
+                            if scheduler[1] is not None:
+                                scheduler[1].step()
+
+                if current_objective * maximize < best_objective * maximize - tolerance:
+                    logger.info(f"[{epoch:03d}|{patience_counter:02d}/{patience:02d}] ---> {current_objective}")
+                    best_state_dict = _copy_state()
+                    best_objective = current_objective
+                    patience_counter = 0
                 else:
-                    # .step() for the rest of the schedulers
-                    if not warmup:
-                        scheduler.step()
-                    else:
-                        if scheduler[1] is not None:
-                            scheduler[1].step()
-
-            if current_objective * maximize < best_objective * maximize - tolerance:
-                logger.info(f"[{epoch:03d}|{patience_counter:02d}/{patience:02d}] ---> {current_objective}")
-                best_state_dict = copy_state(model)
-                best_objective = current_objective
-                patience_counter = 0
-            else:
-                patience_counter += 1
-                logger.info(f"[{epoch:03d}|{patience_counter:02d}/{patience:02d}] ---> {current_objective}")
+                    patience_counter += 1
+                    logger.info(f"[{epoch:03d}|{patience_counter:02d}/{patience:02d}] ---> {current_objective}")
+
+            if (epoch < max_iter) & (lr_decay_steps > 1) & (repeat < lr_decay_steps):
+                decay_lr(model, best_state_dict)
 
-        if (epoch < max_iter) & (lr_decay_steps > 1) & (repeat < lr_decay_steps):
-            decay_lr(model, best_state_dict)
+        finalize(model, best_state_dict)
+    finally:
+        if best_ckpt_path is not None and os.path.exists(best_ckpt_path):
+            os.remove(best_ckpt_path)
 
-    finalize(model, best_state_dict)
+
+def run_early_stopping(step_fn, model, objective, **kwargs):
+    """
+    Callback driven variant of `early_stopping`. Instead of iterating over `early_stopping` in the training loop,
+    `step_fn` is invoked for every epoch.
+    Args:
+        step_fn: function performing the training of one epoch. Called with the positional arguments `epoch` and
+            `current_objective`, i.e. the values that `early_stopping` yields.
+        model: model that is being optimized
+        objective: objective function that is used for early stopping, see `early_stopping`
+        **kwargs: passed on to `early_stopping`
+
+    Returns:
+        Tuple of the last epoch and the corresponding value of the objective, or None if no epoch was run
+    """
+    last = None
+    for epoch, current_objective in early_stopping(model, objective, **kwargs):
+        step_fn(epoch, current_objective)
+        last = epoch, current_objective
+    return last
@@ -1,4 +1,5 @@
 from contextlib import contextmanager
+from itertools import chain
 
 import numpy as np
 import torch
@@ -6,7 +7,7 @@ import torch
 from .training import eval_state
 
 
-def get_module_output(model, input_shape, use_cuda=True):
+def get_module_output(model, input_shape, use_cuda=True, use_meta=False):
     """
     Return the output shape of the model when fed in an array of `input_shape`.
     Note that a zero array of shape `input_shape` is fed into the model and the
@@ -17,19 +18,55 @@ def get_module_output(model, input_shape, use_cuda=True):
         input_shape (tuple): Shape specification for the input array into the model
         use_cuda (bool, optional): If True, model will be evaluated on CUDA if available. Othewrise
             model evaluation will take place on CPU. Defaults to True.
+        use_meta (bool, optional): If True, the output shape is inferred by running the model on tensors on the `meta`
+            device, which only propagates shapes without performing any computation or allocating any memory. Falls back
+            to evaluating the model on actual data if the model cannot be evaluated on the `meta` device, e.g. if any of
+            its operations is not supported there or it holds tensors that are not registered as parameter or buffer.
+            Defaults to False.
 
     Returns:
         tuple: output shape of the model
 
     """
+    if use_meta:
+        try:
+            return _get_module_output_meta(model, input_shape)
+        except (ImportError, NotImplementedError, RuntimeError):
+            # `torch.func` is not available before PyTorch 2.0, some ops are not implemented for the meta device and
+            # tensors that are not registered as parameter or buffer are not moved onto the meta device
+            pass
+
     # infer the original device
     initial_device = next(iter(model.parameters())).device
-    device = "cuda" if torch.cuda.is_available() and use_cuda else "cpu"
+    if torch.cuda.is_available() and use_cuda:
+        device = torch.device("cuda", torch.cuda.current_device())
+    else:
+        device = torch.device("cpu")
+    # only transfer the model if it does not already live on the target device
+    moved = initial_device != device
+    if moved:
+        model.to(device)
     with eval_state(model):
-        with torch.no_grad():
+        with torch.inference_mode():
             input = torch.zeros(1, *input_shape[1:], device=device)
-            output = model.to(device)(input)
-    model.to(initial_device)
+            output = model(input)
+    if moved:
+        model.to(initial_device)
+    return output.shape
+
+
+def _get_module_output_meta(model, input_shape):
+    """
+    Infers the output shape of `model` for inputs of shape `input_shape` by evaluating it on `meta` tensors,
+    without copying or moving the model itself.
+    """
+    from torch.func import functional_call
+
+    meta_state = {k: v.to("meta") for k, v in chain(model.named_parameters(), model.named_buffers())}
+    with eval_state(model):
+        with torch.inference_mode():
+            input = torch.zeros(1, *input_shape[1:], device="meta")
+            output = functional_call(model, meta_state, (input,))
     return output.shape
 
 
@@ -1,8 +1,11 @@
 from typing import Callable, Protocol
 
 import pytest
+import torch
+from torch import nn
 
 from neuralpredictors.layers.cores.conv2d import Stacked2dCore
+from neuralpredictors.utils import _get_module_output_meta, get_module_output
 
 
 class CreateCore(Protocol):
@@ -44,3 +47,27 @@ def test_intermdiate_layers_if_final_nonlinearity_is_false(create_core: CreateCo
 def test_intermediate_layer_if_linear_is_true(create_core: CreateCore) -> None:
     core = create_core(final_nonlinearity=False, linear=True)
     assert not hasattr(core.features[-2], "nonlin")
+
+
+def test_module_output_meta_matches_evaluation(create_core: CreateCore) -> None:
+    core = create_core(final_nonlinearity=True, linear=False)
+    expected = get_module_output(core, (1, 10, 32, 32))
+    # call the meta path directly, as `get_module_output` silently falls back to evaluating the model
+    assert _get_module_output_meta(core, (1, 10, 32, 32)) == expected
+    assert get_module_output(core, (1, 10, 32, 32), use_meta=True) == expected
+
+
+def test_module_output_meta_falls_back_for_unregistered_tensors(create_core: CreateCore) -> None:
+    class Offset(nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.off = torch.ones(1)
+
+        def forward(self, x: torch.Tensor) -> torch.Tensor:
+            return x + self.off
+
+    model = nn.Sequential(create_core(final_nonlinearity=True, linear=False), Offset())
+    with pytest.raises(RuntimeError):
+        _get_module_output_meta(model, (1, 10, 32, 32))
+    expected = get_module_output(model, (1, 10, 32, 32))
+    assert get_module_output(model, (1, 10, 32, 32), use_meta=True) == expected
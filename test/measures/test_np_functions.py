@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from neuralpredictors.measures.np_functions import gini
+
+
+def cumsum_gini(x, axis=None):
+    """Reference implementation of the Gini coefficient based on the cumulative sum of the sorted values."""
+    x = np.asarray(x)
+    if axis is None:
+        x = x.flatten()
+        axis = -1
+    sorted_x = np.sort(x, axis=axis)
+    n = x.shape[axis]
+    cumx = np.cumsum(sorted_x, dtype=float, axis=axis)
+    return (n + 1 - 2 * np.sum(cumx, axis=axis) / cumx.take(-1, axis=axis)) / n
+
+
+@pytest.mark.parametrize("axis", [None, 0, -1])
+def test_gini_matches_cumsum_formula(axis):
+    x = np.random.default_rng(0).random((5, 7, 9))
+    np.testing.assert_allclose(gini(x, axis=axis), cumsum_gini(x, axis=axis))
+
+
+@pytest.mark.parametrize("axis", [None, 0, -1])
+def test_gini_integer_input(axis):
+    x = np.random.default_rng(0).integers(1, 100, size=(6, 8))
+    np.testing.assert_allclose(gini(x, axis=axis), cumsum_gini(x, axis=axis))
+
+
+def test_gini_does_not_modify_input():
+    x = np.random.default_rng(0).random(100)
+    original = x.copy()
+    gini(x)
+    np.testing.assert_array_equal(x, original)
@@ -1,12 +1,15 @@
 import logging
+import tempfile
 from itertools import product
 
 import numpy as np
 import pytest
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch import nn
 
-from neuralpredictors.training import early_stopping
+from neuralpredictors.training import early_stopping, run_early_stopping
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +20,45 @@ class CounterModel(nn.Module):
         self.counter = nn.Parameter(torch.zeros(1))
 
 
+class TiedCounterModel(CounterModel):
+    def __init__(self):
+        super().__init__()
+        self.a = nn.Linear(2, 2, bias=False)
+        self.b = nn.Linear(2, 2, bias=False)
+        self.b.weight = self.a.weight
+
+
+class BufferCounterModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.register_buffer("counter", torch.zeros(1))
+
+
+class ExtraStateCounterModel(CounterModel):
+    def __init__(self):
+        super().__init__()
+        self.restored_counter = None
+
+    def get_extra_state(self):
+        return {"counter": int(self.counter)}
+
+    def set_extra_state(self, state):
+        self.restored_counter = state["counter"]
+
+
+class CounterConfig:
+    def __init__(self, counter):
+        self.counter = counter
+
+
+class ConfigExtraStateCounterModel(ExtraStateCounterModel):
+    def get_extra_state(self):
+        return CounterConfig(int(self.counter))
+
+    def set_extra_state(self, state):
+        self.restored_counter = state.counter
+
+
 class CounterClosure:
     def __init__(self, objective_values):
         self.objective_values = objective_values
@@ -32,6 +74,34 @@ class CounterClosure:
 
 objective_vals = [5, 4, 0.1, 1, 1, 1, 1, 1, 1, 1]
 
+
+class InPlaceCounterClosure(CounterClosure):
+    """Updates the counter with a regular in-place operation, which increments its version counter."""
+
+    def __call__(self, model):
+        ret = self.objective_values[self.counter]
+        self.counter += 1
+        with torch.no_grad():
+            model.counter.add_(1)
+        return ret
+
+
+# objective values of two processes, whose average is best at the third evaluation
+distributed_objective_vals = [[1, 2, 9, 1, 1, 1, 1, 1], [1, 2, 1, 1, 1, 1, 1, 1]]
+
+
+def run_distributed_early_stopping(rank, init_file, results):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=2)
+    try:
+        model = CounterModel()
+        closure = CounterClosure(distributed_objective_vals[rank])
+        for epoch, val in early_stopping(model, closure, patience=2, interval=1, distributed=True):
+            pass
+        torch.save((epoch, val, int(model.counter)), f"{results}{rank}")
+    finally:
+        dist.destroy_process_group()
+
+
 test_data = [
     (patience, interval, maximize, (np.argmax if maximize else np.argmin)(objective_vals))
     for patience, interval, maximize in product(range(1, 4), range(1, 8), [True, False])
@@ -52,3 +122,112 @@ class TestEarlyStopping:
             int(model.counter) == expected_epoch + 2
         )  # +2 because the closure is called two more times after convergence
         assert epoch == (expected_epoch + patience) * interval
+
+    @pytest.mark.parametrize("assign_best_state", [False, True])
+    def test_restore_keeps_tied_weights(self, assign_best_state):
+        model = TiedCounterModel()
+        closure = CounterClosure(objective_vals)
+
+        for epoch, val in early_stopping(model, closure, patience=2, assign_best_state=assign_best_state):
+            pass
+        assert model.a.weight is model.b.weight
+        assert int(model.counter) == np.argmax(objective_vals) + 2
+
+    @pytest.mark.parametrize("assign_best_state", [False, True])
+    def test_restore_model_without_parameters(self, assign_best_state):
+        model = BufferCounterModel()
+        closure = CounterClosure(objective_vals)
+
+        for epoch, val in early_stopping(model, closure, patience=2, assign_best_state=assign_best_state):
+            pass
+        assert int(model.counter) == np.argmax(objective_vals) + 2
+
+    @pytest.mark.parametrize("checkpoint_to_disk", [False, True])
+    @pytest.mark.parametrize("model_class", [ExtraStateCounterModel, ConfigExtraStateCounterModel])
+    def test_restore_extra_state_of_best_epoch(self, checkpoint_to_disk, model_class):
+        model = model_class()
+        closure = CounterClosure(objective_vals)
+
+        for epoch, val in early_stopping(
+            model, closure, maximize=False, patience=2, checkpoint_to_disk=checkpoint_to_disk
+        ):
+            pass
+        assert model.restored_counter == np.argmin(objective_vals) + 1
+
+    def test_distributed_processes_stop_together(self, tmp_path):
+        results = str(tmp_path / "result")
+        mp.spawn(run_distributed_early_stopping, args=(str(tmp_path / "init"), results), nprocs=2)
+
+        outcomes = [torch.load(f"{results}{rank}") for rank in range(2)]
+        # the best state is kept by rank 0 only and broadcast to rank 1 upon restoring
+        expected_counter = np.argmax(np.mean(distributed_objective_vals, axis=0)) + 2
+        assert outcomes[0] == outcomes[1]
+        assert outcomes[0][2] == expected_counter
+
+    @pytest.mark.parametrize("lr_decay_steps", [1, 2])
+    def test_differential_checkpoint_restores_best_state(self, lr_decay_steps):
+        values = objective_vals + [1] * 10
+
+        def run(differential_checkpoint):
+            model = CounterModel()
+            model.frozen = nn.Parameter(torch.ones(3), requires_grad=False)
+            closure = InPlaceCounterClosure(values)
+            for epoch, val in early_stopping(
+                model,
+                closure,
+                maximize=False,
+                patience=2,
+                lr_decay_steps=lr_decay_steps,
+                differential_checkpoint=differential_checkpoint,
+            ):
+                if epoch == 1:
+                    # between two improvements, without incrementing the version counter
+                    model.frozen.data.fill_(2.0)
+            return model
+
+        model, reference = run(True), run(False)
+        assert torch.equal(model.counter, reference.counter)
+        # the differential run skipped the parameter as unchanged, hence kept its previously mirrored value
+        assert torch.equal(model.frozen, torch.ones(3))
+        assert torch.equal(reference.frozen, torch.full((3,), 2.0))
+
+    def test_differential_checkpoint_of_cpu_model_does_not_synchronize_cuda(self, monkeypatch):
+        def synchronize():
+            raise AssertionError("CUDA synchronized for a CPU model")
+
+        monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+        monkeypatch.setattr(torch.cuda, "synchronize", synchronize)
+        model = CounterModel()
+        closure = InPlaceCounterClosure(objective_vals)
+
+        for epoch, val in early_stopping(model, closure, maximize=False, patience=2, differential_checkpoint=True):
+            pass
+        assert int(model.counter) == np.argmin(objective_vals) + 2
+
+    def test_checkpoint_to_disk_restores_best_state_and_cleans_up(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+        model = CounterModel()
+        closure = CounterClosure(objective_vals)
+
+        for epoch, val in early_stopping(model, closure, maximize=False, patience=2, checkpoint_to_disk=True):
+            pass
+        assert int(model.counter) == np.argmin(objective_vals) + 2
+        assert list(tmp_path.iterdir()) == []
+
+    def test_run_early_stopping_matches_iterator(self):
+        model = CounterModel()
+        steps = []
+        last = run_early_stopping(lambda *step: steps.append(step), model, CounterClosure(objective_vals), patience=2)
+
+        reference = list(early_stopping(CounterModel(), CounterClosure(objective_vals), patience=2))
+        assert steps == reference
+        assert last == reference[-1]
+
+    def test_restore_keeps_parameters_by_default(self):
+        model = CounterModel()
+        counter = model.counter
+        closure = CounterClosure(objective_vals)
+
+        for epoch, val in early_stopping(model, closure, patience=2):
+            pass
+        assert model.counter is counter